@@ -3,11 +3,13 @@
 
 from configparser import ConfigParser
 from textwrap import dedent
-from unittest.mock import Mock
+from unittest.mock import Mock, patch
 import gpg
+import io
 import os
 import re
 import shutil
+import smtplib
 import subprocess
 import tempfile
 import unittest
@@ -79,6 +81,10 @@ class ZeypleTest(unittest.TestCase):
         encrypted_payload = encrypted_envelope.get_payload().encode('utf-8')
         decrypted_envelope = self.decrypt(encrypted_payload).decode('utf-8').strip()
 
+        if 'BOUNDARY' not in mime_message:  # single part
+            assert decrypted_envelope == mime_message
+            return
+
         boundary = re.match(r'.+boundary="([^"]+)"',
                             decrypted_envelope, re.MULTILINE | re.DOTALL).group(1)
         # replace auto-generated boundary with one we know
@@ -92,6 +98,19 @@ class ZeypleTest(unittest.TestCase):
 
         assert decrypted_envelope == mime_message
 
+    def test_load_configuration_cache(self):
+        """Parses the config file again only once it has changed"""
+
+        config = self.zeyple.load_configuration(self.conffile)
+        assert config is self.zeyple.config
+
+        stat = os.stat(self.conffile)
+        os.utime(self.conffile, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))
+
+        config = self.zeyple.load_configuration(self.conffile)
+        assert config is not self.zeyple.config
+        assert config.get('relay', 'host') == 'example.net'
+
     def test_user_key(self):
         """Returns the right ID for the given email address"""
 
@@ -103,6 +122,52 @@ class ZeypleTest(unittest.TestCase):
         user_key = self.zeyple._user_key(TEST1_EMAIL_SUBADDRESS)
         assert user_key == TEST1_ID
 
+    def test_resolve_keys(self):
+        """Returns the right IDs for several email addresses at once"""
+
+        assert self.zeyple._resolve_keys([
+            TEST1_EMAIL,
+            TEST1_EMAIL_SUBADDRESS,
+            TEST2_EMAIL,
+            'non_existant@example.org',
+        ]) == {
+            TEST1_EMAIL: TEST1_ID,
+            TEST1_EMAIL_SUBADDRESS: TEST1_ID,
+            TEST2_EMAIL: TEST2_ID,
+            'non_existant@example.org': None,
+        }
+
+    def test_find_keys_with_expired_key(self):
+        """Skips expired keys and keeps searching"""
+
+        assert self.zeyple._find_keys({TEST_EXPIRED_EMAIL, TEST1_EMAIL}) == {
+            TEST1_EMAIL: TEST1_ID,
+            TEST_EXPIRED_EMAIL: zeyple.EXPIRED_KEY,
+        }
+
+    def test_user_key_cache(self):
+        """Caches key lookups, including misses"""
+
+        assert self.zeyple._user_key(TEST1_EMAIL) == TEST1_ID
+        assert self.zeyple._user_key('non_existant@example.org') is None
+
+        self.zeyple._gpg = Mock()  # the keyring must not be searched again
+
+        assert self.zeyple._user_key(TEST1_EMAIL) == TEST1_ID
+        assert self.zeyple._user_key('non_existant@example.org') is None
+        assert not self.zeyple._gpg.method_calls
+
+    @patch('zeyple.zeyple.KEY_CACHE_SIZE', 2)
+    def test_user_key_cache_eviction(self):
+        """Evicts the least recently used key lookup"""
+
+        self.zeyple._user_key(TEST1_EMAIL)
+        self.zeyple._user_key(TEST2_EMAIL)
+        self.zeyple._user_key(TEST1_EMAIL)  # hit
+        self.zeyple._user_key('non_existant@example.org')
+
+        assert list(self.zeyple._key_cache) == [TEST1_EMAIL, 'non_existant@example.org']
+
     def test_encrypt_with_plain_text(self):
         """Encrypts plain text"""
         content = 'The key is under the carpet.'.encode('ascii')
@@ -132,11 +197,9 @@ class ZeypleTest(unittest.TestCase):
         """Encrypts simple messages"""
 
         mime_message = dedent("""\
-            --BOUNDARY
             Content-Type: text/plain
 
-            test
-            --BOUNDARY--""")
+            test""")
 
         email = self.zeyple.process_message(dedent("""\
             Received: by example.org (Postfix, from userid 0)
@@ -155,12 +218,10 @@ class ZeypleTest(unittest.TestCase):
         """Encrypts unicode messages"""
 
         mime_message = dedent("""\
-            --BOUNDARY
             Content-Type: text/plain; charset=utf-8
             Content-Transfer-Encoding: 8bit
 
-            ä ö ü
-            --BOUNDARY--""")
+            ä ö ü""")
 
         email = self.zeyple.process_message(dedent("""\
             Received: by example.org (Postfix, from userid 0)
@@ -232,6 +293,160 @@ class ZeypleTest(unittest.TestCase):
             hello""").encode('ascii'), [TEST1_EMAIL, TEST2_EMAIL])
 
         assert len(emails) == 2  # it has two recipients
+        assert emails[0] is emails[1]  # encrypted only once for both keys
+
+    @patch('smtplib.SMTP')
+    def test_send_messages_over_one_connection(self, smtp):
+        """Reuses the relay connection for all recipients"""
+        del self.zeyple._send_message  # use the real implementation
+
+        self.zeyple.process_message(dedent("""\
+            To: """ + ', '.join([TEST1_EMAIL, TEST2_EMAIL]) + """
+            Subject: Hello
+            From: root@example.org (root)
+
+            hello""").encode('ascii'), [TEST1_EMAIL, TEST2_EMAIL])
+
+        smtp.assert_called_once_with('example.net', 2525)
+        first, second = smtp.return_value.sendmail.call_args_list
+        assert first[0][2] is second[0][2]  # serialized only once
+        smtp.return_value.quit.assert_called_once_with()
+
+    @patch('smtplib.SMTP')
+    def test_reconnect_after_idle_timeout(self, smtp):
+        """Opens a new relay connection when a kept-alive one timed out"""
+        del self.zeyple._send_message  # use the real implementation
+        self.zeyple.keep_alive = True
+
+        message = dedent("""\
+            Subject: Hello
+            From: root@example.org (root)
+
+            hello""").encode('ascii')
+
+        self.zeyple.process_message(message, [TEST1_EMAIL])
+
+        smtp.return_value.sendmail.side_effect = [
+            smtplib.SMTPSenderRefused(421, b'Timeout', 'root@example.org'),
+            None,
+        ]
+        self.zeyple.process_message(message, [TEST1_EMAIL])
+
+        assert smtp.call_count == 2
+        smtp.return_value.close.assert_called_once_with()
+
+    @patch('smtplib.SMTP')
+    def test_send_unencrypted_message_verbatim(self, smtp):
+        """Passes messages without key through untouched but for the header"""
+        del self.zeyple._send_message  # use the real implementation
+
+        filename = os.path.join(os.path.dirname(__file__), 'test.eml')
+        with open(filename, 'rb') as test_file:
+            contents = test_file.read()
+
+        self.zeyple.process_message(contents, ['unknown@zeyple.example.com'])
+
+        # sent with CRLF line endings
+        headers, body = contents.replace(b'\n', b'\r\n').split(b'\r\n\r\n', 1)
+        sent = smtp.return_value.sendmail.call_args[0][2]
+        assert sent.startswith(headers + b'\r\nX-Zeyple: processed by ')
+        assert sent.endswith(b'\r\n\r\n' + body)
+
+    @patch('smtplib.SMTP')
+    def test_send_unencrypted_multipart_body_undecoded(self, smtp):
+        """Does not decode the body of multipart messages passed through"""
+        del self.zeyple._send_message  # use the real implementation
+
+        self.zeyple.process_message(dedent("""\
+            Subject: Hello
+            From: root@example.org (root)
+            Content-Type: multipart/mixed; boundary="BOUNDARY"
+            Content-Transfer-Encoding: quoted-printable
+
+            --BOUNDARY
+            Content-Type: text/plain
+
+            a=3D=
+            b
+            --BOUNDARY--""").encode('ascii'), ['unknown@zeyple.example.com'])
+
+        sent = smtp.return_value.sendmail.call_args[0][2]
+        assert b'a=3D=' in sent
+
+    @patch('smtplib.SMTP')
+    def test_send_unencrypted_delivery_status(self, smtp):
+        """Passes delivery status notifications through"""
+        del self.zeyple._send_message  # use the real implementation
+
+        self.zeyple.process_message(dedent("""\
+            Subject: Delivery Status Notification
+            From: MAILER-DAEMON@example.org
+            Content-Type: message/delivery-status
+
+            Reporting-MTA: dns; example.org
+
+            Final-Recipient: rfc822; root@example.org
+            Action: failed
+            """).encode('ascii'), ['unknown@zeyple.example.com'])
+
+        sent = smtp.return_value.sendmail.call_args[0][2]
+        assert sent.endswith(
+            b'\r\n\r\nReporting-MTA: dns; example.org\r\n\r\n'
+            b'Final-Recipient: rfc822; root@example.org\r\nAction: failed\r\n')
+
+    @patch('smtplib.SMTP')
+    def test_send_unencrypted_attached_message(self, smtp):
+        """Sends message/rfc822 bodies with CRLF line endings"""
+        del self.zeyple._send_message  # use the real implementation
+
+        self.zeyple.process_message(dedent("""\
+            Subject: Fwd: Hello
+            From: root@example.org (root)
+            Content-Type: message/rfc822
+
+            Subject: Hello
+            From: root@example.org (root)
+
+            hello
+            """).encode('ascii'), ['unknown@zeyple.example.com'])
+
+        sent = smtp.return_value.sendmail.call_args[0][2]
+        assert sent.endswith(
+            b'\r\n\r\nSubject: Hello\r\nFrom: root@example.org (root)\r\n\r\nhello\r\n')
+        assert not re.search(rb'(?<!\r)\n', sent)
+
+    def test_frames(self):
+        """Reads back the frames sent to the daemon"""
+        stream = io.BytesIO()
+        zeyple.write_frame(stream, [TEST1_EMAIL, TEST2_EMAIL], b'Subject: x\n\ntest')
+        zeyple.write_frame(stream, [], b'')
+        zeyple.write_frame(stream, ['"a,b"@example.org'], b'')
+        stream.seek(0)
+
+        assert zeyple.read_frame(stream) == ([TEST1_EMAIL, TEST2_EMAIL], b'Subject: x\n\ntest')
+        assert zeyple.read_frame(stream) == ([], b'')
+        assert zeyple.read_frame(stream) == (['"a,b"@example.org'], b'')
+        assert zeyple.read_frame(stream) is None
+
+    def test_malformed_frames(self):
+        """Rejects frames that were not written by write_frame"""
+        for data in [b'\0\0', b'\0\0\0\x05abc', b'\0\0\0\x03abc']:
+            with self.assertRaises(ValueError):
+                zeyple.read_frame(io.BytesIO(data))
+
+    def test_process_message_with_expired_recipient_key(self):
+        """Drops the recipient whose key is expired, not the others"""
+
+        emails = self.zeyple.process_message(dedent("""\
+            Subject: Hello
+            From: root@example.org (root)
+
+            hello""").encode('ascii'), [TEST1_EMAIL, TEST_EXPIRED_EMAIL])
+
+        assert len(emails) == 1  # never sent unencrypted
+        assert emails[0].get_content_type() == 'multipart/encrypted'
+        self.zeyple._send_message.assert_called_once()
+        assert self.zeyple._send_message.call_args[0][1] == TEST1_EMAIL
 
     def test_process_message_with_complex_message(self):
         """Encrypts complex messages"""
@@ -250,6 +465,7 @@ class ZeypleTest(unittest.TestCase):
 
         # set force_encrypt
         self.zeyple.config.set('zeyple', 'force_encrypt', '1')
+        self.zeyple._resolve_configuration()
 
         sent_messages = self.zeyple.process_message(contents, ['unknown@zeyple.example.com'])
         assert len(sent_messages) == 0
@@ -258,3 +474,4 @@ class ZeypleTest(unittest.TestCase):
         assert len(sent_messages) == 1
 
         self.zeyple.config.remove_option('zeyple', 'force_encrypt')
+        self.zeyple._resolve_configuration()
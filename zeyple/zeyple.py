@@ -2,17 +2,60 @@
 # -*- coding: utf-8 -*-
 
 from configparser import ConfigParser
-import copy
 import email
-import email.encoders
-import email.mime.application
-import email.mime.multipart
-import gpg
+import email.generator
+import email.message
+import email.parser
+import email.policy
+import email.utils
+import io
 import logging
 import os
 import re
-import smtplib
 import sys
+import time
+
+
+# gpg, smtplib and email.mime are slow to import and are loaded through
+# these accessors on first use. gpg is still needed for every processed
+# message (recipient keys are looked up first), but e.g. the --socket client
+# imports none of them and email.mime is only loaded to encrypt. Likewise,
+# socket and socketserver are only imported by the daemon mode functions.
+def _import_gpg():
+    import gpg
+    return gpg
+
+
+def _import_smtplib():
+    import smtplib
+    return smtplib
+
+
+def _import_mime():
+    from email import encoders
+    from email.mime import application, nonmultipart
+    return encoders, application, nonmultipart
+
+
+# same rules as Message.set_param, adapted from email.message._formatparam
+def _format_param(param, value):
+    """Formats a Content-Type parameter, quoting its value only if needed"""
+    if not value:
+        return param
+
+    if isinstance(value, tuple):  # RFC 2231 (charset, language, value)
+        value = email.utils.encode_rfc2231(value[2], value[0], value[1])
+        return '%s*=%s' % (param, value)
+
+    try:
+        value.encode('ascii')
+    except UnicodeEncodeError:
+        value = email.utils.encode_rfc2231(value, 'utf-8', '')
+        return '%s*=%s' % (param, value)
+
+    if _TSPECIALS_RE.search(value):
+        return '%s="%s"' % (param, email.utils.quote(value))
+    return '%s=%s' % (param, value)
 
 
 def encode_string(string):
@@ -28,12 +71,42 @@ __author__ = 'Cédric Félizard'
 __license__ = 'AGPLv3+'
 __copyright__ = 'Copyright 2012-2024 Cédric Félizard'
 
+ZEYPLE_HEADER = "processed by {0} v{1}".format(__title__, __version__)
+
+KEY_CACHE_SIZE = 1024
+KEY_CACHE_TTL = 300  # seconds
+
+# stands for the key ID of recipients whose only key is expired
+EXPIRED_KEY = object()
+
+_SUBADDRESS_RE = re.compile(r'\+[^@]+')
+
+# RFC 2045 tspecials and space, which require a parameter value to be quoted
+_TSPECIALS_RE = re.compile(r'[ ()<>@,;:\\"/\[\]?=]')
+
+# SMTP requires CRLF line endings
+_EOL_RE = re.compile(rb'\r\n|\r|\n')
+_BARE_EOL_RE = re.compile(rb'\r(?!\n)|(?<!\r)\n')
+
+# parsed configurations by file name, along with the files' mtimes
+_CONFIG_CACHE = {}
+
+# daemon mode frames: length of the rest, NUL-separated recipients,
+# newline, raw message
+_FRAME_HEADER_SIZE = 4  # big-endian
+
 
 class Zeyple:
     """Zeyple Encrypts Your Precious Log Emails"""
 
     def __init__(self, config_fname='zeyple.conf'):
         self.config = self.load_configuration(config_fname)
+        self._gpg = None
+        self._smtp = None
+        self.keep_alive = False  # keep the relay connection between messages
+
+        self._key_cache = {}
+        self._resolve_configuration()
 
         if self.config.has_option('zeyple', 'log_file'):
             log_file = self.config.get('zeyple', 'log_file')
@@ -46,75 +119,147 @@ class Zeyple:
             logging.disable()
 
     def load_configuration(self, filename):
-        """Reads and parses the config file"""
+        """Reads and parses the config file, unless it is unchanged"""
 
-        config = ConfigParser()
-        config.read([
+        paths = [
             os.path.join('/etc/', filename),
             filename,
-        ])
+        ]
+
+        stamps = []
+        for path in paths:
+            try:
+                stamps.append((path, os.stat(path).st_mtime_ns))
+            except OSError:
+                pass
+        stamps = tuple(stamps)
+
+        cached = _CONFIG_CACHE.get(filename)
+        if cached is not None and cached[0] == stamps:
+            return cached[1]
+
+        config = ConfigParser()
+        config.read(paths)
         if not config.sections():
             raise IOError('Cannot open config file.')
+
+        _CONFIG_CACHE[filename] = (stamps, config)
         return config
 
+    def _resolve_configuration(self):
+        """Looks up the settings used for every message once and for all"""
+        config = self.config
+
+        self._force_encrypt = config.has_option('zeyple', 'force_encrypt') and \
+            config.getboolean('zeyple', 'force_encrypt')
+        self._add_header = config.has_option('zeyple', 'add_header') and \
+            config.getboolean('zeyple', 'add_header')
+
+        self._relay_host = config.get('relay', 'host')
+        self._relay_port = config.getint('relay', 'port')
+
+        if config.has_option('gpg', 'executable'):
+            self._gpg_executable = config.get('gpg', 'executable')
+        else:
+            self._gpg_executable = None  # Default value
+        self._gpg_home = config.get('gpg', 'home')
+
+        if config.has_option('gpg', 'key_cache_ttl'):
+            self._key_cache_ttl = config.getint('gpg', 'key_cache_ttl')
+        else:
+            self._key_cache_ttl = KEY_CACHE_TTL
+
+        if config.has_section('keyaliases'):
+            self._keyaliases = dict(config.items('keyaliases'))
+        else:
+            self._keyaliases = {}
+
     @property
     def gpg(self):
-        protocol = gpg.constants.PROTOCOL_OpenPGP
+        """GPG context, created once and reused for every operation"""
+        if self._gpg is not None:
+            return self._gpg
 
-        if self.config.has_option('gpg', 'executable'):
-            executable = self.config.get('gpg', 'executable')
-        else:
-            executable = None  # Default value
+        gpg = _import_gpg()
 
-        home_dir = self.config.get('gpg', 'home')
+        protocol = gpg.constants.PROTOCOL_OpenPGP
 
         ctx = gpg.Context()
-        ctx.set_engine_info(protocol, executable, home_dir)
+        ctx.set_engine_info(protocol, self._gpg_executable, self._gpg_home)
         ctx.armor = True
 
+        self._gpg = ctx
         return ctx
 
     def process_message(self, message_data, recipients):
         """Encrypts the message with recipient keys"""
         message_data = encode_string(message_data)
 
-        in_message = email.message_from_bytes(message_data)
+        key_ids = self._resolve_keys(recipients)
+        all_key_ids = [
+            key_id for key_id in dict.fromkeys(key_ids.values())
+            if key_id and key_id is not EXPIRED_KEY
+        ]
+
+        # the MIME structure is only needed when something gets encrypted
+        in_message = email.parser.BytesParser(policy=email.policy.compat32).parsebytes(
+            message_data, headersonly=not all_key_ids)
         logging.info(
             "Processing outgoing message %s", in_message['Message-id'])
 
         if not recipients:
             logging.warn("Cannot find any recipients, ignoring")
 
-        sent_messages = []
         for recipient in recipients:
             logging.info("Recipient: %s", recipient)
+            logging.info("Key ID: %s", key_ids[recipient])
 
-            key_id = self._user_key(recipient)
-            logging.info("Key ID: %s", key_id)
-
-            if key_id:
-                out_message = self._encrypt_message(in_message, key_id)
-
-            elif self.config.has_option('zeyple', 'force_encrypt') and \
-                    self.config.getboolean('zeyple', 'force_encrypt'):
-                logging.error("No keys found, message will not be sent!")
-                continue
+        # a single ciphertext encrypted to every key serves all recipients
+        encrypted_message = encrypted_data = None
+        if all_key_ids:
+            encrypted_message = self._encrypt_message(in_message, all_key_ids)
+            self._add_zeyple_header(encrypted_message)
+            encrypted_data = self._flatten(encrypted_message)
 
-            else:
-                logging.warn("No keys found, message will be sent unencrypted")
-                out_message = copy.copy(in_message)
-
-            self._add_zeyple_header(out_message)
-            self._send_message(out_message, recipient)
-            sent_messages.append(out_message)
+        plain_message = plain_data = None
+        sent_messages = []
+        try:
+            for recipient in recipients:
+                if key_ids[recipient] is EXPIRED_KEY:
+                    logging.error("Key is expired, message will not be sent!")
+                    continue
+
+                elif key_ids[recipient]:
+                    out_message, out_data = encrypted_message, encrypted_data
+
+                elif self._force_encrypt:
+                    logging.error("No keys found, message will not be sent!")
+                    continue
+
+                else:
+                    logging.warn("No keys found, message will be sent unencrypted")
+                    if plain_message is None:
+                        # in_message is not needed anymore once encrypted
+                        plain_message = in_message
+                        self._add_zeyple_header(plain_message)
+                        plain_data = self._flatten(plain_message)
+                    out_message, out_data = plain_message, plain_data
+
+                self._send_message(out_message, recipient, out_data)
+                sent_messages.append(out_message)
+        finally:
+            if not self.keep_alive:
+                self._close_smtp()
 
         return sent_messages
 
     def _get_version_part(self):
-        ret = email.mime.application.MIMEApplication(
+        encoders, application, _ = _import_mime()
+
+        ret = application.MIMEApplication(
             'Version: 1\n',
             'pgp-encrypted',
-            email.encoders.encode_noop,
+            encoders.encode_noop,
         )
         ret.add_header(
             'Content-Description',
@@ -124,10 +269,12 @@ class Zeyple:
         return ret
 
     def _get_encrypted_part(self, payload):
-        ret = email.mime.application.MIMEApplication(
+        encoders, application, _ = _import_mime()
+
+        ret = application.MIMEApplication(
             payload,
             'octet-stream',
-            email.encoders.encode_noop,
+            encoders.encode_noop,
             name="encrypted.asc",
         )
         ret.add_header('Content-Description', "OpenPGP encrypted message")
@@ -139,35 +286,67 @@ class Zeyple:
         del ret['MIME-Version']
         return ret
 
-    def _encrypt_message(self, in_message, key_id):
-        if in_message.is_multipart():
-            # get the body (after the first \n\n)
-            payload = in_message.as_string().split("\n\n", 1)[1].strip()
+    def _write_multipart_payload(self, message, fp):
+        """Writes the Content-Type and the parts of a multipart message"""
+        boundary = message.get_boundary().encode('ascii', 'surrogateescape')
+        policy = message.policy.clone(max_line_length=0)  # don't refold headers
+        generator = email.generator.BytesGenerator(
+            fp, mangle_from_=False, policy=policy)
+
+        # keep the Content-Type including the boundary
+        fp.write(b'Content-Type: ')
+        fp.write(message['Content-Type'].encode('ascii', 'surrogateescape'))
+        fp.write(b'\n\n')
 
-            # prepend the Content-Type including the boundary
-            content_type = "Content-Type: " + in_message["Content-Type"]
-            payload = content_type + "\n\n" + payload
+        if message.preamble:
+            fp.write(message.preamble.encode('ascii', 'surrogateescape'))
+            fp.write(b'\n')
 
-            message = email.message.Message()
-            message.set_payload(payload)
+        for part in message.get_payload():
+            fp.write(b'--' + boundary + b'\n')
+            generator.flatten(part)
+            fp.write(b'\n')
+        fp.write(b'--' + boundary + b'--')
 
-            payload = message.get_payload()
+        if message.epilogue:
+            fp.write(b'\n')
+            fp.write(message.epilogue.encode('ascii', 'surrogateescape'))
+
+    def _encrypt_message(self, in_message, key_ids):
+        _, _, nonmultipart = _import_mime()
+
+        # the cleartext is streamed into a buffer that GPG reads in place
+        payload = io.BytesIO()
+
+        if in_message.is_multipart():
+            self._write_multipart_payload(in_message, payload)
 
         else:
-            message = email.mime.nonmultipart.MIMENonMultipart(
+            message = nonmultipart.MIMENonMultipart(
                 in_message.get_content_maintype(),
                 in_message.get_content_subtype()
             )
-            payload = encode_string(in_message.get_payload())
-            message.set_payload(payload)
+            # raw payload: 8bit content is written back byte for byte
+            # instead of being decoded and encoded again
+            message.set_payload(in_message._payload)
 
-            # list of additional parameters in content-type
+            # list of additional parameters in content-type, written to the
+            # header at once
             params = in_message.get_params()
             if params:
                 # first item is the main/sub type so discard it
                 del params[0]
+            if params:
+                # a repeated parameter replaces the earlier one in place,
+                # as set_param would
+                unique = {}
                 for param, value in params:
-                    message.set_param(param, value, "Content-Type", False)
+                    unique[param.lower()] = (param, value)
+
+                content_type = [message.get_content_type()]
+                for param, value in unique.values():
+                    content_type.append(_format_param(param, value))
+                message.replace_header('Content-Type', '; '.join(content_type))
 
             encoding = in_message["Content-Transfer-Encoding"]
             if encoding:
@@ -175,44 +354,34 @@ class Zeyple:
 
             del message['MIME-Version']
 
-            mixed = email.mime.multipart.MIMEMultipart(
-                'mixed',
-                None,
-                [message],
-            )
-
-            # remove superfluous header
-            del mixed['MIME-Version']
+            # the single part is encrypted as is, without a multipart wrapper
+            email.generator.BytesGenerator(
+                payload, mangle_from_=False).flatten(message)
 
-            payload = mixed.as_bytes()
-
-        encrypted_payload = self._encrypt_payload(payload, [key_id])
+        encrypted_payload = self._encrypt_payload(payload, key_ids)
 
         version = self._get_version_part()
         encrypted = self._get_encrypted_part(encrypted_payload)
 
-        out_message = copy.copy(in_message)
+        # only the raw headers are kept, the original body is replaced anyway
+        out_message = email.message.Message()
+        out_message._headers = [
+            (name, value) for name, value in in_message._headers
+            if name.lower() not in ('content-type', 'content-transfer-encoding')
+        ]
+
         out_message.preamble = "This is an OpenPGP/MIME encrypted " \
                                "message (RFC 4880 and 3156)"
 
-        if 'Content-Type' not in out_message:
-            out_message['Content-Type'] = 'multipart/encrypted'
-        else:
-            out_message.replace_header(
-                'Content-Type',
-                'multipart/encrypted',
-            )
-        del out_message['Content-Transfer-Encoding']
+        out_message['Content-Type'] = 'multipart/encrypted'
         out_message.set_param('protocol', 'application/pgp-encrypted')
         out_message.set_payload([version, encrypted])
 
         return out_message
 
     def _encrypt_payload(self, payload, key_ids):
-        """Encrypts the payload with the given keys"""
-        payload = encode_string(payload)
-
-        self.gpg.armor = True
+        """Encrypts the payload (bytes or binary buffer) with the given keys"""
+        gpg = _import_gpg()
 
         recipient = [self.gpg.get_key(key_id) for key_id in key_ids]
 
@@ -222,65 +391,311 @@ class Zeyple:
                     "Key with user email %s "
                     "is expired!".format(key.uids[0].email))
 
-        (ciphertext, encresult, signresult) = self.gpg.encrypt(
-            gpg.Data(string=payload),
-            recipients=recipient,
-            sign=False,
-            always_trust=True
-        )
+        # the key IDs are left out of the ciphertext so that recipients
+        # can't tell who else the message was encrypted to
+        flags = gpg.constants.ENCRYPT_ALWAYS_TRUST | gpg.constants.ENCRYPT_THROW_KEYIDS
+        ciphertext = gpg.Data()
+
+        # bytes and BytesIO objects are wrapped by GPGME without copying
+        self.gpg.op_encrypt(recipient, flags, payload, ciphertext)
 
-        return ciphertext
+        result = self.gpg.op_encrypt_result()
+        if result.invalid_recipients:
+            raise gpg.errors.InvalidRecipients(result.invalid_recipients)
+
+        ciphertext.seek(0, os.SEEK_SET)
+        return ciphertext.read()
 
     def _user_key(self, email):
         """Returns the GPG key for the given email address"""
-        logging.info("Trying to encrypt for %s", email)
-
-        # Check if there is a keyalias set for the email
-        # and use the replacement email for retrieving keys if so 
-        if self.config.has_option('keyaliases', email):
-            email=self.config.get('keyaliases', email)
+        return self._resolve_keys([email])[email]
+
+    def _resolve_keys(self, emails):
+        """Returns the GPG keys for the given email addresses
+
+        Addresses missing from the cache are all looked up with a single
+        keyring search.
+        """
+        now = time.monotonic()
+
+        key_ids = {}
+        missing = []
+        for email in emails:
+            cached = self._key_cache.pop(email, None)
+            if cached is not None and cached[0] > now:
+                # moved to the end so that the least recently used go first
+                self._key_cache[email] = cached
+                key_ids[email] = cached[1]
+            elif email not in missing:
+                missing.append(email)
+
+        if not missing:
+            return key_ids
+
+        candidates = {email: self._key_candidates(email) for email in missing}
+        found = self._find_keys({c for cs in candidates.values() for c in cs})
+
+        for email in missing:
+            logging.info("Trying to encrypt for %s", email)
+
+            key_id = None
+            for candidate in candidates[email]:
+                if candidate in found:
+                    key_id = found[candidate]
+                    break
+            key_ids[email] = key_id
+
+            # Negative results are cached as well
+            if len(self._key_cache) >= KEY_CACHE_SIZE:
+                del self._key_cache[next(iter(self._key_cache))]
+            self._key_cache[email] = (now + self._key_cache_ttl, key_id)
+
+        return key_ids
+
+    def _key_candidates(self, email):
+        """Lists the addresses whose key may be used for the given one"""
+        candidates = []
+        while email not in candidates:
+            # Check if there is a keyalias set for the email
+            # and use the replacement email for retrieving keys if so
+            email = self._keyaliases.get(self.config.optionxform(email), email)
+            candidates.append(email)
+
+            # Strip sub addressing tag
+            email = _SUBADDRESS_RE.sub('', email)
+
+        return candidates
+
+    def _find_keys(self, emails):
+        """Maps the given email addresses to the first key with that uid
+
+        Addresses that only have expired keys are mapped to EXPIRED_KEY.
+        """
+        found = {}
+        expired = set()
+        if not emails:
+            return found
 
         # Explicit matching of email and uid.email necessary.
-        # Otherwise gpg.keylist will return a list of keys
+        # Otherwise the keylist will also return keys
         # for searches like "n"
-        for key in self.gpg.keylist(email):
-            for uid in key.uids:
-                if uid.email == email:
-                    return key.subkeys[0].keyid
+        ctx = self.gpg
+        ctx.op_keylist_ext_start(sorted(emails), 0, 0)
+        try:
+            key = ctx.op_keylist_next()
+            while key:
+                if key.expired:
+                    logging.warn("Ignoring expired key %s", key.subkeys[0].keyid)
+                    expired.update(uid.email for uid in key.uids)
+                    key = ctx.op_keylist_next()
+                    continue
+
+                for uid in key.uids:
+                    if uid.email in emails and uid.email not in found:
+                        found[uid.email] = key.subkeys[0].keyid
+                key = ctx.op_keylist_next()
+        finally:
+            ctx.op_keylist_end()
+
+        for email in expired & emails:
+            found.setdefault(email, EXPIRED_KEY)
+
+        return found
 
-        # Strip sub addressing tag
-        submail = re.sub('(\\+[^@]+)', '', email)
-        if submail != email:
-            return self._user_key(submail)
+    def _add_zeyple_header(self, message):
+        if self._add_header:
+            message['X-Zeyple'] = ZEYPLE_HEADER
+
+    def _smtp_connection(self):
+        """Returns the SMTP connection to the relay, opening it if needed"""
+        smtplib = _import_smtplib()
+
+        if self._smtp is None:
+            self._smtp = smtplib.SMTP(self._relay_host, self._relay_port)
+        return self._smtp
+
+    def _close_smtp(self):
+        if self._smtp is None:
+            return
+
+        smtplib = _import_smtplib()
+
+        try:
+            self._smtp.quit()
+        except smtplib.SMTPException:
+            self._smtp.close()
+        self._smtp = None
+
+    def _flatten(self, message):
+        """Serializes the message for SMTP, keeping 8bit content as is"""
+        fp = io.BytesIO()
+
+        if isinstance(message._payload, str) and \
+                message.get_content_maintype() in ('multipart', 'message'):
+            # multipart or message/* body left unparsed by the headers-only
+            # parser, which the generator can't handle: write it back verbatim
+            policy = message.policy.clone(max_line_length=0, linesep='\r\n')
+            for name, value in message.raw_items():
+                fp.write(policy.fold_binary(name, value))
+            fp.write(b'\r\n')
+            body = message._payload.encode('ascii', 'surrogateescape')
+            fp.write(_EOL_RE.sub(b'\r\n', body))
+        else:
+            email.generator.BytesGenerator(
+                fp, mangle_from_=False, maxheaderlen=0).flatten(message, linesep='\r\n')
 
-        return None
+        data = fp.getvalue()
 
-    def _add_zeyple_header(self, message):
-        if self.config.has_option('zeyple', 'add_header') and \
-           self.config.getboolean('zeyple', 'add_header'):
-            message.add_header(
-                'X-Zeyple',
-                "processed by {0} v{1}".format(__title__, __version__)
-            )
+        # raw 8bit header values are written back with their own line breaks
+        end = data.find(b'\r\n\r\n')
+        if end < 0:
+            end = len(data)
+        if _BARE_EOL_RE.search(data, 0, end):
+            data = _EOL_RE.sub(b'\r\n', data[:end]) + data[end:]
 
-    def _send_message(self, message, recipient):
-        """Sends the given message through the SMTP relay"""
-        logging.info("Sending message %s", message['Message-id'])
+        return data
 
-        smtp = smtplib.SMTP(self.config.get('relay', 'host'),
-                            self.config.getint('relay', 'port'))
+    def _send_message(self, message, recipient, data):
+        """Sends the given message, serialized as data, through the SMTP relay"""
+        smtplib = _import_smtplib()
 
-        smtp.sendmail(message['From'], recipient, message.as_string())
-        smtp.quit()
+        logging.info("Sending message %s", message['Message-id'])
+
+        reused = self._smtp is not None
+        try:
+            self._smtp_connection().sendmail(message['From'], recipient, data)
+        except (smtplib.SMTPServerDisconnected, smtplib.SMTPResponseException) as error:
+            # the relay closes kept-alive connections that sat idle for too
+            # long (421 reply or plain disconnection), try a fresh one then
+            if not reused or getattr(error, 'smtp_code', 421) != 421:
+                raise
+            self._smtp.close()
+            self._smtp = None
+            self._smtp_connection().sendmail(message['From'], recipient, data)
 
         logging.info("Message %s sent", message['Message-id'])
 
 
+def write_frame(fp, recipients, message_data):
+    """Writes a message and its recipients to a daemon as one frame"""
+    recipients = '\0'.join(recipients).encode('utf-8') + b'\n'
+    fp.write((len(recipients) + len(message_data)).to_bytes(_FRAME_HEADER_SIZE, 'big'))
+    fp.write(recipients)
+    fp.write(message_data)
+
+
+def read_frame(fp):
+    """Reads a frame written by write_frame, returns None once fp is exhausted
+
+    Raises ValueError if the frame is malformed.
+    """
+    header = fp.read(_FRAME_HEADER_SIZE)
+    if not header:
+        return None
+    if len(header) != _FRAME_HEADER_SIZE:
+        raise ValueError('Truncated frame header')
+
+    length = int.from_bytes(header, 'big')
+    body = fp.read(length)
+    if len(body) != length:
+        raise ValueError('Truncated frame')
+
+    recipients, separator, message_data = body.partition(b'\n')
+    if not separator:
+        raise ValueError('Missing recipients separator')
+    recipients = recipients.decode('utf-8')  # UnicodeDecodeError is a ValueError
+    return recipients.split('\0') if recipients else [], message_data
+
+
+def _process_frames(zeyple, rfile, wfile):
+    """Processes the frames read from a daemon connection, answering each"""
+    while True:
+        try:
+            frame = read_frame(rfile)
+        except ValueError:
+            # the stream can't be resynchronized, give up on it
+            logging.exception("Cannot read frame")
+            wfile.write(b'ERR\n')
+            break
+        if frame is None:
+            break
+        recipients, message_data = frame
+
+        try:
+            zeyple.process_message(message_data, recipients)
+            wfile.write(b'OK\n')
+        except Exception:
+            logging.exception("Cannot process message")
+            wfile.write(b'ERR\n')
+
+
+def serve(socket_path, config_fname='zeyple.conf'):
+    """Runs Zeyple as a daemon processing the frames sent to socket_path"""
+    import socketserver
+
+    class FilterHandler(socketserver.StreamRequestHandler):
+        def handle(self):
+            _process_frames(zeyple, self.rfile, self.wfile)
+
+    zeyple = Zeyple(config_fname)
+    zeyple.keep_alive = True
+
+    try:
+        os.unlink(socket_path)  # left over by a previous run
+    except FileNotFoundError:
+        pass
+
+    server = socketserver.UnixStreamServer(socket_path, FilterHandler)
+    logging.info("Listening on %s", socket_path)
+
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        os.unlink(socket_path)
+        zeyple._close_smtp()
+
+
+def submit(socket_path, recipients, message_data):
+    """Hands a message over to the daemon, returns whether it was processed"""
+    import socket
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(socket_path)
+        with sock.makefile('rwb') as fp:
+            write_frame(fp, recipients, message_data)
+            fp.flush()
+            return fp.readline() == b'OK\n'
+
+
+USAGE = """usage: zeyple.py RECIPIENT...
+       zeyple.py --socket SOCKET RECIPIENT...
+       zeyple.py --daemon SOCKET"""
+
+
 if __name__ == '__main__':
-    recipients = sys.argv[1:]
+    if sys.argv[1:2] == ['--daemon']:
+        if len(sys.argv) != 3:
+            print(USAGE, file=sys.stderr)
+            sys.exit(os.EX_USAGE)
+        serve(sys.argv[2])
+        sys.exit()
+
+    if sys.argv[1:2] == ['--socket'] and len(sys.argv) < 3:
+        print(USAGE, file=sys.stderr)
+        sys.exit(os.EX_USAGE)
 
     binary_stdin = sys.stdin.buffer
     message = binary_stdin.read()
 
+    if sys.argv[1:2] == ['--socket']:
+        try:
+            processed = submit(sys.argv[2], sys.argv[3:], message)
+        except OSError:
+            processed = False
+        sys.exit(0 if processed else os.EX_TEMPFAIL)  # let Postfix retry later
+
+    recipients = sys.argv[1:]
+
     zeyple = Zeyple()
     zeyple.process_message(message, recipients)